@@ -27,10 +27,30 @@ import os
 import getpass
 import asyncio
 import sys
+import functools
+import signal
+import types
+import collections
+import typing
+import time
+import shlex
+import queue
+import threading
+import errno
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # PyYAML built without libyaml, use the pure python loader
+    from yaml import SafeLoader as YamlLoader
 
 print = asfpy.syslog.Printer(stdout=True, identity="occ")
 
 ME = asfpy.whoami.whoami()
+ME_USER = getpass.getuser()
+
+# Placeholders in oncommit arguments, and the commit fields they are replaced with
+PLACEHOLDERS = {"$branch": "ref", "$hash": "hash"}
+
 TMPL_FAILURE = ME + """ failed to reconfigure due to the following error(s):
 
 Return code: %d
@@ -39,6 +59,115 @@ Error message: %s
 Please fix this error before service can resume.
 """
 
+# Working dir and per-user command environments, refreshed on SIGHUP
+CWD = os.getcwd()
+USER_ENV = {}
+
+# Background tasks, per-subscription command queues (so a hook never runs alongside
+# itself), limits on queued and running commands across all subscriptions, and
+# commits held back by subscriptions with a batch_latency set
+TASKS = set()
+MAX_CONCURRENT = 4
+MAX_QUEUED = 64
+SUB_QUEUES = {}
+QUEUE_SLOTS = None
+RUN_SLOTS = None
+BATCH_MAX = 100
+BATCHES = {}
+BATCH_TIMERS = {}
+
+# How many lines of command output to hold on to for failure reports
+OUTPUT_TAIL = 100
+
+# Identical failure reports are only mailed once per this many seconds
+BLAME_WINDOW = 300
+RECENT_BLAMES = {}
+
+# Outgoing mails, sent by a background thread so a slow mail server can't hold up commands
+MAIL_QUEUE = queue.Queue(maxsize=256)
+
+# Recently processed commits, pubsub may send these again when we reconnect
+SEEN_COMMITS = collections.OrderedDict()
+SEEN_MAX = 4096
+
+
+class Subscription(typing.NamedTuple):
+    """ A subscription from occ.yaml, with its topics split up ready for matching """
+    name: str
+    topics: frozenset
+    changedirs: tuple = ()
+    command: tuple = ()
+    substitutions: tuple = ()
+    runas: str = ME_USER
+    skiprest: bool = False
+    blamelist: str = None
+    blamesubject: str = "OCC execution failure"
+    batch_latency: float = 0
+    batch_max: int = BATCH_MAX
+
+
+def compile_command(oncommit):
+    """ Splits an oncommit setting into an argument template and the positions of $branch/$hash placeholders in it """
+    if isinstance(oncommit, str):
+        return (oncommit,), ()
+    if isinstance(oncommit, list):
+        substitutions = tuple((index, PLACEHOLDERS[arg]) for index, arg in enumerate(oncommit) if arg in PLACEHOLDERS)
+        return tuple(oncommit), substitutions
+    return (), ()
+
+
+def changedir_prefixes(changedir):
+    """ A changedir can be a single path prefix or a list of them """
+    if not changedir:
+        return ()
+    if isinstance(changedir, str):
+        return (changedir,)
+    return tuple(changedir)
+
+
+def compile_subscriptions(config):
+    """ Turns the subscriptions section of occ.yaml into a list of Subscription objects """
+    subscriptions = []
+    for subkey, subdata in config.get('subscriptions', {}).items():
+        command, substitutions = compile_command(subdata.get('oncommit'))
+        subscriptions.append(Subscription(
+            name=subkey,
+            topics=frozenset(subdata.get('topics').split('/')),
+            changedirs=changedir_prefixes(subdata.get('changedir')),
+            command=command,
+            substitutions=substitutions,
+            runas=subdata.get('runas', ME_USER),
+            skiprest=subdata.get('skiprest') == True,
+            blamelist=subdata.get('blamelist'),
+            blamesubject=subdata.get('blamesubject', "OCC execution failure"),
+            batch_latency=subdata.get('batch_latency', 0),
+            batch_max=subdata.get('batch_max', BATCH_MAX),
+        ))
+    return subscriptions
+
+
+class ChangeDirIndex:
+    """ Finds all changedir prefixes that a commit touches, in one pass over its changed files """
+
+    def __init__(self, prefixes):
+        self.prefixes = frozenset(prefixes)
+        self.lengths = sorted(set(len(prefix) for prefix in self.prefixes))
+
+    def matches(self, changed_files):
+        """ Returns the set of prefixes that at least one of the changed files starts with """
+        hits = set()
+        for change in changed_files:
+            # A file can only start with a prefix if its first len(prefix) chars *are* the prefix,
+            # so look up each distinct prefix length rather than trying every prefix in turn.
+            for length in self.lengths:
+                if length > len(change):
+                    break
+                if change[:length] in self.prefixes:
+                    hits.add(change[:length])
+            if len(hits) == len(self.prefixes):  # Everything matched already, no need to look further
+                break
+        return hits
+
 
 class CommandException(Exception):
     reason: str
@@ -49,39 +178,93 @@ class CommandException(Exception):
         self.exitcode = exitcode
 
 
-async def run_as(username=getpass.getuser(), args=()):
+@functools.lru_cache(maxsize=128)
+def _pwrecord(username):
+    """ Cached passwd lookup, NSS may well be LDAP/SSSD backed. Cleared on SIGHUP """
+    return pwd.getpwnam(username)
+
+
+def user_env(username, pw_record):
+    """ Returns the (read-only) environment for running commands as a user.
+    Commands only get PATH and LANG from our own environment, plus the usual user variables """
+    env = USER_ENV.get(username)
+    if env is None:
+        env = {
+            'PATH': os.environ.get('PATH', os.defpath),
+            'LANG': os.environ.get('LANG', 'C'),
+            'HOME': pw_record.pw_dir,
+            'LOGNAME': pw_record.pw_name,
+            'PWD': CWD,
+            'USER': username,
+        }
+        env = USER_ENV[username] = types.MappingProxyType(env)
+    return env
+
+
+def reload_users(*_):
+    """ SIGHUP handler, drops cached user records and environments """
+    global CWD
+    CWD = os.getcwd()
+    _pwrecord.cache_clear()
+    USER_ENV.clear()
+
+
+async def run_as(username=ME_USER, args=()):
     """ Run a command as a specific user """
     if not args:
         return   # Nothing to do? boooo
     try:
-        pw_record = pwd.getpwnam(username)
+        if username in USER_ENV:  # Looked up already, so the record is in the lru cache
+            pw_record = _pwrecord(username)
+        else:  # NSS lookups can block on LDAP/SSSD, do uncached ones in the loop's shared thread pool
+            pw_record = await asyncio.get_event_loop().run_in_executor(None, _pwrecord, username)
     except KeyError:
         print("Could not execute command as %s - user not found??" % username)
         raise CommandException("Subprocess error - could not run command as non-existent user %s" % username, 7)
-    user_name = pw_record.pw_name
     user_uid = pw_record.pw_uid
     user_gid = pw_record.pw_gid
-    env = os.environ.copy()
-    env['HOME'] = pw_record.pw_dir
-    env['LOGNAME'] = user_name
-    env['PWD'] = os.getcwd()
-    env['USER'] = username
-    print("Running command %s as user %s..." % (" ".join(args), username))
+    env = user_env(username, pw_record)
+    # The one place the full command line gets logged, quoted so it can be copy/pasted into a shell
+    print("Running command %s as user %s..." % (" ".join(map(shlex.quote, args)), username))
+    if user_uid == os.geteuid() and user_gid == os.getegid():
+        # Already running as this user. Without a uid/gid switch CPython (3.10+) can
+        # spawn the command via vfork instead of a full fork of this process
+        popen_user = {}
+    elif sys.version_info >= (3, 9):
+        # Let the C-level child setup do the uid/gid switch, no python code in the forked child
+        popen_user = {"user": user_uid, "group": user_gid}
+    else:
+        popen_user = {"preexec_fn": change_user(user_uid, user_gid)}
     try:
-        process = subprocess.Popen(
-            args, preexec_fn=change_user(user_uid, user_gid), cwd=os.getcwd(), env=env, stdout=subprocess.PIPE, 
-            stderr=subprocess.STDOUT, universal_newlines=True
+        process = await asyncio.create_subprocess_exec(
+            *args, cwd=CWD, env=env, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT, start_new_session=True, **popen_user
         )
-        stdout_data, stderr_data = process.communicate(timeout=30)
-        if stdout_data:
-            print(stdout_data)    
+        output = collections.deque(maxlen=OUTPUT_TAIL)
+        try:
+            await asyncio.wait_for(read_output(process, output), timeout=30)
+        except asyncio.TimeoutError:
+            # Kill the whole process group, so anything the command left running in the
+            # background (and holding on to its stdout) goes away with it
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:  # Exited just as we timed out
+                pass
+            try:  # wait() also waits for the pipes to close, don't let a stray daemon hold us up
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                print("Command did not go away after being killed, giving up on it")
+            raise
     except FileNotFoundError:
         print("Could not find script or executable to run, %s" % args[0])
         raise CommandException("Could not find executable '%s'" % args[0], 1)
-    except PermissionError:
+    except PermissionError as e:
+        if e.errno == errno.EPERM and "user" in popen_user:  # setuid/setgid in the child was refused
+            print("Subprocess error - could not change to user %s" % username)
+            raise CommandException("Subprocess error - unable to change to user %s for running command (permission denied?)" % username, 7)
         print("Permission denied while trying to run %s" % args[0])
         raise CommandException("Got permission denied while trying to run '%s'" % args[0], 13)
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         print("Execution timed out")
         raise CommandException("Subprocess error - execution of command timed out", 2)
     except subprocess.SubprocessError:
@@ -89,73 +272,226 @@ async def run_as(username=getpass.getuser(), args=()):
         raise CommandException("Subprocess error - unable to change to user %s for running command (permission denied?)" % username, 7)
     if process.returncode != 0:
         print("on-commit command failed with exit code %d!" % process.returncode)
-        raise CommandException(stderr_data.decode('utf-8'), process.returncode)
+        raise CommandException("\n".join(output), process.returncode)
+
+
+async def read_output(process, output):
+    """ Logs the output of a command line by line as it runs, keeping the last lines of it in output """
+    while True:
+        try:
+            line = await process.stdout.readline()
+        except ValueError:  # Line too long for the stream buffer, it has been discarded
+            print("[output line too long, skipped]")
+            continue
+        if not line:
+            break
+        line = line.decode('utf-8', errors='replace').rstrip()  # Hooks may print anything, don't fail on it
+        print(line)
+        output.append(line)
+    await process.wait()
 
 
 def change_user(user_uid, user_gid):
+    """ preexec_fn fallback for Python<3.9, which lacks the user/group arguments to Popen """
     def result():
         os.setgid(user_gid)
         os.setuid(user_uid)
     return result
 
 
-async def parse_commit(payload, config):
+def command_args(sub, commits):
+    """ Builds the argument list for a command, filling in $branch/$hash from one or more (batched) commits """
+    cmd_args = list(sub.command)
+    for index, key in sub.substitutions:
+        cmd_args[index] = " ".join(dict.fromkeys(commit.get(key, "??") for commit in commits))
+    return cmd_args
+
+
+def spawn(coro):
+    """ Runs a coroutine in the background, holding a reference to it until it is done """
+    task = asyncio.ensure_future(coro)
+    TASKS.add(task)
+    task.add_done_callback(TASKS.discard)
+    return task
+
+
+async def run_subscription(sub, cmd_args):
+    """ Runs the command for a subscription, notifying the blamelist if it fails """
+    print("Found a matching payload for %s, preparing to execute command:" % sub.name)
+    try:
+        await run_as(sub.runas, cmd_args)
+        print("Command executed successfully")
+    except CommandException as e:
+        print("on-commit command failed with exit code %d!" % e.exitcode)
+        if sub.blamelist:
+            send_blame(sub.blamelist, sub.blamesubject, TMPL_FAILURE % (e.exitcode, e.reason))
+
+
+def send_blame(recipient, subject, message):
+    """ Mails error details to a blamelist, unless the very same mail went out less than BLAME_WINDOW seconds ago """
+    now = time.monotonic()
+    for key, sent in list(RECENT_BLAMES.items()):  # Forget about reports that are old enough to be resent
+        if now - sent >= BLAME_WINDOW:
+            del RECENT_BLAMES[key]
+    key = (recipient, subject, message)
+    if key in RECENT_BLAMES:
+        print("Identical error details were sent to %s less than %d seconds ago, not sending again" % (recipient, BLAME_WINDOW))
+        return
+    RECENT_BLAMES[key] = now
+    print("Sending error details to %s" % recipient)
+    try:
+        MAIL_QUEUE.put_nowait({"recipient": recipient, "subject": subject, "message": message})
+    except queue.Full:
+        print("Mail queue is full, dropping error report to %s!" % recipient)
+
+
+def mail_sender():
+    """ Sends queued up mails, runs in its own (daemon) thread """
+    while True:
+        mail = MAIL_QUEUE.get()
+        try:
+            asfpy.messaging.mail(**mail)
+        except Exception as e:  # Keep going, the next mail may well get through
+            print("Could not send mail to %s: %s" % (mail["recipient"], e))
+
+
+async def queue_command(sub, cmd_args):
+    """ Queues up a command for a subscription, waiting while MAX_QUEUED commands are already queued or running """
+    await QUEUE_SLOTS.acquire()
+    SUB_QUEUES[sub.name].put_nowait(cmd_args)
+
+
+async def subscription_worker(sub, commands):
+    """ Runs the queued up commands of a subscription one after the other, in order.
+    Workers of different subscriptions run side by side, MAX_CONCURRENT at a time """
+    while True:
+        cmd_args = await commands.get()
+        try:
+            async with RUN_SLOTS:
+                await run_subscription(sub, cmd_args)
+        except Exception as e:  # Don't let one broken command take the worker down with it
+            print("Unexpected error while running command for %s: %s" % (sub.name, e))
+        finally:
+            QUEUE_SLOTS.release()
+
+
+def take_batch(sub):
+    """ Takes all commits batched up so far for a subscription, cancelling its flush timer """
+    timer = BATCH_TIMERS.pop(sub.name, None)
+    if timer:
+        timer.cancel()
+    commits = BATCHES.pop(sub.name, None)
+    if commits:
+        print("Flushing %d batched commit(s) for %s" % (len(commits), sub.name))
+    return commits
+
+
+def flush_batch(sub):
+    """ Timer callback, runs the command for a subscription once for all commits batched up so far.
+    If the command queue is full, the commits stay batched and we try again later """
+    if QUEUE_SLOTS.locked():
+        print("Command queue is full, holding on to batched commits for %s a while longer" % sub.name)
+        loop = asyncio.get_event_loop()
+        BATCH_TIMERS[sub.name] = loop.call_later(sub.batch_latency, flush_batch, sub)
+        return
+    commits = take_batch(sub)
+    if commits:
+        spawn(queue_command(sub, command_args(sub, commits)))
+
+
+async def batch_commit(sub, commit):
+    """ Queues up a commit for a batching subscription, flushing when the batch is full or old enough """
+    batch = BATCHES.setdefault(sub.name, collections.deque())
+    batch.append(commit)
+    if len(batch) >= sub.batch_max:  # Like unbatched commands, this waits for room in the command queue
+        await queue_command(sub, command_args(sub, take_batch(sub)))
+    elif sub.name not in BATCH_TIMERS:
+        loop = asyncio.get_event_loop()
+        BATCH_TIMERS[sub.name] = loop.call_later(sub.batch_latency, flush_batch, sub)
+
+
+def changed_files(payload):
+    """ Returns the files changed by a commit payload """
+    commit = payload.get('commit', {})
+    if commit and 'changed' in commit:
+        return commit.get('changed').keys()  # svn syntax
+    elif commit and 'files' in commit:
+        return commit.get('files')  # git syntax
+    return []
+
+
+def seen_before(payload):
+    """ Returns True if this commit has already been processed, remembering it otherwise """
+    commit = payload.get('commit', {})
+    if 'hash' in commit:  # git, the same commit may legitimately be pushed to other branches or repos
+        key = (commit.get('repository'), commit.get('ref'), commit['hash'])
+    elif 'id' in commit:  # svn revisions are only unique per repository
+        key = (commit.get('repository'), commit['id'])
+    else:
+        return False
+    if key in SEEN_COMMITS:
+        SEEN_COMMITS.move_to_end(key)
+        return True
+    SEEN_COMMITS[key] = None
+    if len(SEEN_COMMITS) > SEEN_MAX:
+        SEEN_COMMITS.popitem(last=False)
+    return False
+
+
+async def parse_commit(payload, subscriptions, changedirs):
     if 'stillalive' in payload:  # Ping, Pong...
         return
-    for _subkey, subdata in config.get('subscriptions', {}).items():
-        sub_topics = subdata.get('topics').split('/')
-        sub_changedir = subdata.get('changedir')
-        if all(topic in payload['pubsub_topics'] for topic in sub_topics):
+    if seen_before(payload):
+        print("Ignoring commit we have already processed (replayed by pubsub?)")
+        return
+    payload_topics = frozenset(payload['pubsub_topics'])
+    changedir_hits = None  # Worked out the first time a subscription needs it
+    for sub in subscriptions:
+        if sub.topics <= payload_topics:
             matches = True
-            if sub_changedir:  # If we require changes within a certain dir in the repo..
-                matches = False
-                changed_files = []
-                commit = payload.get('commit', {})
-                if commit and 'changed' in commit:
-                    changed_files = commit.get('changed').keys()  # svn syntax
-                elif commit and 'files' in commit:
-                    changed_files = commit.get('files')  # git syntax
-                for change in changed_files:
-                    if change.startswith(sub_changedir):
-                        matches = True
-                        break
+            if sub.changedirs:  # If we require changes within certain dirs in the repo..
+                if changedir_hits is None:
+                    changedir_hits = changedirs.matches(changed_files(payload))
+                matches = any(prefix in changedir_hits for prefix in sub.changedirs)
             if matches:
-                oncommit = subdata.get('oncommit')
-                runas = subdata.get('runas', getpass.getuser())
-                if oncommit:
-                    cmd_args = []
-                    if isinstance(oncommit, str):
-                        cmd_args = [oncommit]
-                    elif isinstance(oncommit, list):
-                        for cmd_arg in oncommit:
-                            if cmd_arg == "$branch":
-                                cmd_arg = payload.get("commit", {}).get("ref", "??")
-                            if cmd_arg == "$hash":
-                                cmd_arg = payload.get("commit", {}).get("hash", "??")
-                            cmd_args.append(cmd_arg)
-                    if cmd_args:
-                        print("Found a matching payload, preparing to execute command '%s':" % " ".join(cmd_args))
-                        blamelist = subdata.get('blamelist')
-                        blamesubject = subdata.get('blamesubject', "OCC execution failure")
-                        try:
-                            await run_as(runas, cmd_args)
-                            print("Command executed successfully")
-                        except CommandException as e:
-                            print("on-commit command failed with exit code %d!" % e.exitcode)
-                            if blamelist:
-                                print("Sending error details to %s" % blamelist)
-                                asfpy.messaging.mail(recipient=blamelist, subject=blamesubject, message=TMPL_FAILURE % (e.exitcode, e.reason))
-                    if subdata.get('skiprest') == True:
-                        print("Skiprest enabled, skipping any other commands that may fire from this commit")
-                        break
+                if sub.command:
+                    commit = payload.get("commit", {})
+                    if sub.batch_latency:  # Coalesce bursts of commits into a single run
+                        await batch_commit(sub, commit)
+                    else:
+                        cmd_args = command_args(sub, [commit])
+                        if cmd_args:  # Blocks while the command queue is full, which stops us reading from pubsub
+                            await queue_command(sub, cmd_args)
+                if sub.skiprest:
+                    print("Skiprest enabled, skipping any other commands that may fire from this commit")
+                    break
 
 
 async def main():
     print("Loading occ.yaml")
-    cfg = yaml.safe_load(open('occ.yaml'))
+    with open('occ.yaml', 'rb') as f:
+        cfg = yaml.load(f, Loader=YamlLoader)
+    # Handled as a loop callback, so caches are never cleared halfway through a coroutine step
+    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reload_users)
+    subscriptions = compile_subscriptions(cfg)
+    changedirs = ChangeDirIndex(prefix for sub in subscriptions for prefix in sub.changedirs)
+    for runas in set(sub.runas for sub in subscriptions):  # Prepare environments for all users up front
+        try:
+            user_env(runas, _pwrecord(runas))
+        except KeyError:
+            print("Warning: subscriptions are configured to run as %s, but no such user exists!" % runas)
+    global QUEUE_SLOTS, RUN_SLOTS, BLAME_WINDOW
+    BLAME_WINDOW = cfg.get('blame_window', BLAME_WINDOW)
+    threading.Thread(target=mail_sender, daemon=True).start()
+    QUEUE_SLOTS = asyncio.Semaphore(cfg.get('max_queued', MAX_QUEUED))
+    RUN_SLOTS = asyncio.Semaphore(cfg.get('max_concurrent', MAX_CONCURRENT))
+    for sub in subscriptions:
+        SUB_QUEUES[sub.name] = asyncio.Queue()
+        spawn(subscription_worker(sub, SUB_QUEUES[sub.name]))
     print("Listening to pyPubSub stream at %s" % cfg['pubsub']['url'])
     async for payload in asfpy.pubsub.listen(cfg['pubsub']['url'], username=cfg['pubsub']['user'], password=cfg['pubsub']['pass']):
-        await parse_commit(payload, cfg)
+        # Commands are run by the workers, this only waits if too many of them are already queued up
+        await parse_commit(payload, subscriptions, changedirs)
 
 
 if __name__ == "__main__":